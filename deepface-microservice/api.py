@@ -1,45 +1,252 @@
+import asyncio
 import logging
-from pydantic import BaseModel
-from deepface import DeepFace
-from fastapi import FastAPI, HTTPException
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, UploadFile
 import uvicorn
 import numpy as np
-import requests
+import numba
+import onnxruntime as ort
+import httpx
 import cv2
-import base64
+import pybase64
+from turbojpeg import TurboJPEG, TJPF_BGR
 
 # --- Setup ---
-app = FastAPI(title="Face Verification API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Models load & warm up when each worker starts serving, not at import
+    load_sessions()
+    BATCHER.start()
+    yield
+    await BATCHER.stop()
+    await CLIENT.aclose()
+
+app = FastAPI(title="Face Verification API", lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Model & Constants (Same as before) ---
 FACE_MODEL = "ArcFace"
 DISTANCE_METRIC = "cosine"
-FACE_DETECTOR_BACKEND = "opencv"
+FACE_DETECTOR_BACKEND = "yunet"
+
+# Models are produced by export_models.py
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+ARCFACE_MODEL_PATH = os.path.join(MODELS_DIR, "arcface.onnx")
+DETECTOR_MODEL_PATH = os.path.join(MODELS_DIR, "face_detection_yunet_2023mar.onnx")
+ANTISPOOF_MODEL_PATH = os.path.join(MODELS_DIR, "anti_spoof.onnx")
+
+ORT_PROVIDERS = ["TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider"]
+ARCFACE_INPUT = "input"
+FACE_SIZE = 112
+EMBEDDING_SIZE = 512
+MAX_BATCH_SIZE = 8
+BATCH_TIMEOUT = 0.005 # Seconds the batcher waits for more crops before running ArcFace
+
+# TensorRT engine precision: "fp32", "fp16" or "int8" (int8 needs a calibration table, see export_models.py)
+TRT_PRECISION = os.getenv("TRT_PRECISION", "fp16")
+TRT_ENGINE_CACHE_DIR = os.path.join(MODELS_DIR, "trt_cache")
+TRT_INT8_CALIBRATION_TABLE = "calibration.flatbuffers"
+
+# CPU threads for the ArcFace session. Concurrent runs share this one pool; the anti-spoofing
+# session adds one more thread, so size it so that (uvicorn workers x (ORT_INTRA_OP_THREADS + 1))
+# matches the core count instead of oversubscribing.
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", "4"))
+# DeepFace's ArcFace/cosine threshold, valid for the same input scaling DeepFace uses
+# (BGR, 0-1 pixels, see preprocess). Alignment differs (5-point warp vs. DeepFace's eye
+# rotation), so validate on labelled pairs and override via env if the distribution shifts.
+VERIFICATION_THRESHOLD = float(os.getenv("VERIFICATION_THRESHOLD", "0.68"))
+DETECTION_SCORE_THRESHOLD = 0.9
+MAX_DETECTION_SIDE = 1024 # Longer uploads are downscaled before detection
+# MiniFASNet anti-spoofing: two 80x80 crops around the face at these box scales
+ANTISPOOF_CROP_SIZE = 80
+ANTISPOOF_SCALES = (2.7, 4.0)
+# Max inference jobs running in worker threads at once; the rest wait on the event loop
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "4"))
+REG_EMBEDDING_CACHE_SIZE = 4096
+
+# ArcFace's canonical 5-point landmark positions in a 112x112 crop:
+# right eye, left eye, nose tip, right mouth corner, left mouth corner
+ARCFACE_REFERENCE_LANDMARKS = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32)
+ARCFACE_REFERENCE_MEAN = ARCFACE_REFERENCE_LANDMARKS.mean(axis=0)
+ARCFACE_REFERENCE_CENTERED = ARCFACE_REFERENCE_LANDMARKS - ARCFACE_REFERENCE_MEAN
+
+# --- Process-wide Sessions (loaded & warmed once) ---
+def session_providers() -> list:
+    """
+    Available execution providers in priority order.
+    TensorRT builds a reduced-precision engine once and persists it in TRT_ENGINE_CACHE_DIR,
+    so later starts only deserialize it.
+    """
+    shape = f"{FACE_SIZE}x{FACE_SIZE}"
+    trt_options = {
+        "trt_fp16_enable": TRT_PRECISION in ("fp16", "int8"),
+        "trt_int8_enable": TRT_PRECISION == "int8",
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": TRT_ENGINE_CACHE_DIR,
+        "trt_timing_cache_enable": True,
+        # One optimization profile covering every batch size we run
+        "trt_profile_min_shapes": f"{ARCFACE_INPUT}:1x3x{shape}",
+        "trt_profile_opt_shapes": f"{ARCFACE_INPUT}:2x3x{shape}",
+        "trt_profile_max_shapes": f"{ARCFACE_INPUT}:{MAX_BATCH_SIZE}x3x{shape}",
+    }
+    if TRT_PRECISION == "int8":
+        trt_options["trt_int8_calibration_table_name"] = TRT_INT8_CALIBRATION_TABLE
+
+    available = ort.get_available_providers()
+    return [
+        (p, trt_options) if p == "TensorrtExecutionProvider" else p
+        for p in ORT_PROVIDERS if p in available
+    ]
+
+def session_options(intra_op_threads: int = ORT_INTRA_OP_THREADS) -> ort.SessionOptions:
+    """ Pinned thread counts and full graph optimization (Conv+BN folding etc.) for a session. """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+# Set by load_sessions() from the lifespan handler
+SESSION = None
+SESSION_INPUT = None
+SESSION_OUTPUT = None
+USE_IO_BINDING = False
+DETECTOR = None
+SPOOFER = None
+SPOOFER_INPUTS = None
+
+def load_sessions():
+    """
+    Loads the ArcFace, detector and anti-spoofing models, then pushes dummy inputs through them
+    so cuDNN kernel selection / TensorRT engine loading happen now instead of on the first request.
+    """
+    global SESSION, SESSION_INPUT, SESSION_OUTPUT, USE_IO_BINDING, DETECTOR, SPOOFER, SPOOFER_INPUTS
+
+    if "VERIFICATION_THRESHOLD" not in os.environ:
+        logger.warning(
+            f"VERIFICATION_THRESHOLD is the unvalidated default ({VERIFICATION_THRESHOLD}), carried over from "
+            "DeepFace's opencv-detector/eye-rotation pipeline. It has not been calibrated for the YuNet + "
+            "5-point alignment pipeline; check same/different-person distances on labelled pairs and set it explicitly."
+        )
 
-logger.info(f"Loading facial model: {FACE_MODEL}...")
-DeepFace.build_model(FACE_MODEL)
-logger.info("Facial model loaded successfully.")
+    logger.info(f"Loading facial model: {FACE_MODEL} ({ARCFACE_MODEL_PATH}, TensorRT precision: {TRT_PRECISION})...")
+    SESSION = ort.InferenceSession(ARCFACE_MODEL_PATH, sess_options=session_options(), providers=session_providers())
+    SESSION_INPUT = SESSION.get_inputs()[0].name
+    SESSION_OUTPUT = SESSION.get_outputs()[0].name
+    USE_IO_BINDING = SESSION.get_providers()[0] != "CPUExecutionProvider"
+    # JIT-compile the preprocessing kernel now rather than on the first request
+    preprocess(np.zeros((FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8))
+    # Every batch size the batcher can produce, so none of them pays autotuning
+    # (or device buffer allocation) later
+    for batch_size in range(1, MAX_BATCH_SIZE + 1):
+        run_arcface(np.zeros((batch_size, 3, FACE_SIZE, FACE_SIZE), dtype=np.float32))
+    logger.info(f"Facial model loaded successfully on {SESSION.get_providers()[0]}.")
+
+    DETECTOR = cv2.FaceDetectorYN.create(
+        DETECTOR_MODEL_PATH, "", (320, 320), score_threshold=DETECTION_SCORE_THRESHOLD
+    )
+    DETECTOR.detect(np.zeros((320, 320, 3), dtype=np.uint8))
+    # Tiny model, called concurrently from the run_inference threads: kept on the CPU so the
+    # GPU is only ever driven by the batcher's single ArcFace thread
+    SPOOFER = ort.InferenceSession(
+        ANTISPOOF_MODEL_PATH,
+        # 80x80 MiniFASNet: one thread is plenty and keeps it from adding a second full-size pool
+        sess_options=session_options(intra_op_threads=1),
+        providers=["CPUExecutionProvider"]
+    )
+    SPOOFER_INPUTS = [i.name for i in SPOOFER.get_inputs()]
+    crop_shape = (1, 3, ANTISPOOF_CROP_SIZE, ANTISPOOF_CROP_SIZE)
+    SPOOFER.run(None, {name: np.zeros(crop_shape, dtype=np.float32) for name in SPOOFER_INPUTS})
+
+# cv2 DNN nets aren't safe to share between threads, so detector calls are serialized
+DETECTOR_LOCK = threading.Lock()
+INFERENCE_SEMAPHORE = asyncio.Semaphore(INFERENCE_CONCURRENCY)
+
+def check_jpeg_codec():
+    """
+    Non-JPEG uploads are decoded with cv2.imdecode, which is only fast when OpenCV is linked
+    against libjpeg-turbo with SIMD enabled (the opencv-python wheels are). Warn if this build isn't.
+    """
+    build_info = cv2.getBuildInformation().splitlines()
+    jpeg = next((line.split(":", 1)[1].strip() for line in build_info if line.strip().startswith("JPEG:")), "unknown")
+    simd = any(line.split() == ["SIMD", "Support:", "YES"] for line in build_info)
+    if "libjpeg-turbo" in jpeg and simd:
+        logger.info(f"OpenCV JPEG codec: {jpeg} (SIMD enabled)")
+    else:
+        logger.warning(f"OpenCV JPEG codec is {jpeg} (SIMD: {simd}); image decoding will be slow. "
+                       "Install an OpenCV build linked against libjpeg-turbo.")
+
+check_jpeg_codec()
+# PyTurboJPEG is a ctypes wrapper around the system libturbojpeg; without it JPEGs decode via OpenCV
+try:
+    TJ = TurboJPEG()
+except (RuntimeError, OSError) as e:
+    logger.warning(f"libturbojpeg unavailable ({e}); decoding JPEGs with cv2.imdecode instead.")
+    TJ = None
+
+# Shared HTTP client: keeps TCP/TLS connections to the image host alive between requests
+CLIENT = httpx.AsyncClient(timeout=5.0, http2=True, limits=httpx.Limits(max_connections=100))
 
 # --- Pydantic Models for JSON Payloads ---
+# Base64 fields can be megabytes long: keep them out of reprs/logs
 class DetectFacePayload(BaseModel):
-    img: str  # The registered image as a Base64 string
+    img: str = Field(..., repr=False)  # The registered image as a Base64 string
 
 class VerifyFacePayload(BaseModel):
     regimg: str
-    verimg: str
+    verimg: str = Field(..., repr=False)
+
+# --- Pydantic Models for JSON Responses ---
+# Declared response models let FastAPI serialize straight through pydantic-core
+class DetectFaceResponse(BaseModel):
+    status: str
+    is_real: bool
+    antispoof_score: float
+    face_height_ratio: float
+
+class VerifyFaceResponse(BaseModel):
+    is_match: bool
+    distance: float
+    threshold: float
+    time: float
+    ratio: float
 
 # --- Helper function ---
-def read_image_from_url(url: str) -> np.ndarray:
+def decode_image(img_bytes: bytes) -> np.ndarray:
+    """
+    Decodes image bytes into a BGR image, the channel order the detector and ArcFace take.
+    JPEGs are decoded by libjpeg-turbo straight into BGR (no extra swizzle pass) when libturbojpeg is installed;
+    anything else, and JPEGs TurboJPEG can't convert to BGR (e.g. CMYK/YCCK), falls back to cv2.imdecode.
+    """
+    if TJ is not None and img_bytes[:2] == b"\xff\xd8":
+        try:
+            return TJ.decode(img_bytes, pixel_format=TJPF_BGR)
+        except OSError as e:
+            logger.info(f"TurboJPEG could not decode image ({e}); falling back to OpenCV.")
+    return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+async def read_image_from_url(url: str) -> np.ndarray:
     """Downloads an image from a URL into an OpenCV-compatible image."""
     try:
-        response = requests.get(url)
+        response = await CLIENT.get(url)
         response.raise_for_status() # Raise an error for bad responses (4xx, 5xx)
-        # Convert downloaded bytes into numpy array
-        nparr = np.frombuffer(response.content, np.uint8)
-        # Decode array into OpenCV BGR image
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Decode downloaded bytes into an OpenCV BGR image
+        img = decode_image(response.content)
         if img is None:
             raise ValueError("Could not decode image from URL.")
         return img
@@ -50,13 +257,14 @@ def read_image_from_url(url: str) -> np.ndarray:
 def read_image_from_base64(b64_string: str) -> np.ndarray:
     """Decodes a Base64 string into an OpenCV-compatible image."""
     try:
-        # Check/Remove Data URI prefix if present
-        if "," in b64_string:
-            b64_string = b64_string.split(",")[1]
-            
-        img_bytes = base64.b64decode(b64_string)
-        nparr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Check/Remove Data URI prefix if present ("data:image/jpeg;base64,...").
+        # Only the head is searched so megabyte payloads aren't scanned or split.
+        prefix_end = b64_string.find(",", 0, 128)
+        if prefix_end != -1:
+            b64_string = b64_string[prefix_end + 1:]
+
+        # pybase64 decodes with SIMD; the bytes go straight to the decoder without a numpy copy
+        img = decode_image(pybase64.b64decode(b64_string, validate=False))
         if img is None:
             raise ValueError("Could not decode image from Base64 string.")
         return img
@@ -64,45 +272,344 @@ def read_image_from_base64(b64_string: str) -> np.ndarray:
         logger.error(f"Error reading Base64 image: {e}")
         raise HTTPException(status_code=400, detail=f"Invalid Base64 image: {str(e)}")
 
-# --- Internal Verification Logic ---
-def perform_verification(regimg: np.ndarray, verimg: np.ndarray) -> dict:
-    """ Runs DeepFace.verify and returns a structured dictionary. """
-    
-    ver_img_height = verimg.shape[0]
-    
+def read_image_from_bytes(img_bytes: bytes) -> np.ndarray:
+    """Decodes raw uploaded image bytes into an OpenCV-compatible image."""
     try:
-        result = DeepFace.verify(
-            img1_path=regimg,
-            img2_path=verimg,
-            model_name=FACE_MODEL,
-            anti_spoofing=True
+        img = decode_image(img_bytes)
+        if img is None:
+            raise ValueError("Could not decode uploaded image.")
+        return img
+    except Exception as e:
+        logger.error(f"Error reading uploaded image: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid image upload: {str(e)}")
+
+# --- Face Pipeline ---
+def detect_faces(img: np.ndarray) -> list:
+    """
+    Runs the cached face detector over a BGR image.
+    Returns one dict per face with its facial_area, 5 landmarks and confidence,
+    in the coordinates of the original image.
+    """
+    # Detection cost grows with pixel count, so large phone photos are shrunk to
+    # MAX_DETECTION_SIDE first and the results scaled back up.
+    img_height, img_width = img.shape[:2]
+    scale = min(1.0, MAX_DETECTION_SIDE / max(img_height, img_width))
+    if scale < 1.0:
+        img_width, img_height = int(img_width * scale), int(img_height * scale)
+        img = cv2.resize(img, (img_width, img_height), interpolation=cv2.INTER_AREA)
+
+    with DETECTOR_LOCK:
+        DETECTOR.setInputSize((img_width, img_height))
+        _, detections = DETECTOR.detect(img)
+    if detections is None:
+        return []
+    detections[:, :14] /= scale
+
+    faces = []
+    for row in detections:
+        x, y, w, h = (int(v) for v in row[:4])
+        faces.append({
+            "facial_area": {"x": x, "y": y, "w": w, "h": h},
+            "landmarks": row[4:14].reshape(5, 2),
+            "confidence": float(row[14]),
+        })
+    return faces
+
+def detect_primary_face(img: np.ndarray) -> dict:
+    """ Returns the most confident face, raising ValueError if there is none. """
+    faces = detect_faces(img)
+    if not faces:
+        raise ValueError("Face could not be detected in the image.")
+    return max(faces, key=lambda face: face["confidence"])
+
+def similarity_transform(landmarks: np.ndarray) -> np.ndarray:
+    """
+    Closed-form least-squares similarity (rotation, uniform scale, translation) mapping the
+    5 detected landmarks onto ArcFace's reference points, as a 2x3 affine matrix.
+    Same fit as cv2.estimateAffinePartial2D without its robust-estimator iterations.
+    """
+    src_mean = landmarks.mean(axis=0)
+    src = landmarks - src_mean
+    dst = ARCFACE_REFERENCE_CENTERED
+    norm = (src ** 2).sum()
+    a = (src * dst).sum() / norm
+    b = (src[:, 0] * dst[:, 1] - src[:, 1] * dst[:, 0]).sum() / norm
+    rotation = np.array([[a, -b], [b, a]], dtype=np.float32)
+    translation = ARCFACE_REFERENCE_MEAN - rotation @ src_mean
+    return np.hstack([rotation, translation[:, np.newaxis]])
+
+def align_face(img: np.ndarray, landmarks: np.ndarray) -> np.ndarray:
+    """ Warps the face onto ArcFace's 112x112 reference landmarks (OpenCV's SIMD warp path). """
+    return cv2.warpAffine(
+        img, similarity_transform(landmarks), (FACE_SIZE, FACE_SIZE),
+        flags=cv2.INTER_LINEAR, borderValue=0.0
+    )
+
+@numba.njit(fastmath=True, nogil=True, cache=True)
+def _preprocess_kernel(crop, out):
+    """
+    One pass over the uint8 HWC crop: cast, x / 255 and HWC -> CHW, writing each
+    output plane contiguously. Not parallel: a 112x112 crop is too small to amortize thread
+    start-up, and nogil already lets the run_inference threads preprocess side by side.
+    """
+    height, width, channels = crop.shape
+    for c in range(channels):
+        for y in range(height):
+            for x in range(width):
+                out[c, y, x] = np.float32(crop[y, x, c]) * np.float32(1.0 / 255.0)
+
+def preprocess(crop: np.ndarray) -> np.ndarray:
+    """
+    uint8 HWC BGR crop -> float32 CHW tensor in [0, 1]. This is exactly what DeepFace feeds the
+    same ArcFace weights (normalization="base"), so VERIFICATION_THRESHOLD keeps its meaning.
+    """
+    out = np.empty((crop.shape[2], crop.shape[0], crop.shape[1]), dtype=np.float32)
+    _preprocess_kernel(crop, out)
+    return out
+
+# GPU only: per batch size, a persistent CUDA input/output buffer pair bound to the ArcFace session.
+# Only used from the batcher's single inference thread (and warm-up), so the buffers aren't shared.
+IO_BINDINGS = {}
+
+def get_io_binding(batch_size: int) -> tuple:
+    """ Returns (io_binding, device input, device output) for a batch size, allocating them once. """
+    if batch_size not in IO_BINDINGS:
+        input_value = ort.OrtValue.ortvalue_from_shape_and_type(
+            [batch_size, 3, FACE_SIZE, FACE_SIZE], np.float32, "cuda", 0
         )
+        output_value = ort.OrtValue.ortvalue_from_shape_and_type(
+            [batch_size, EMBEDDING_SIZE], np.float32, "cuda", 0
+        )
+        io_binding = SESSION.io_binding()
+        io_binding.bind_ortvalue_input(SESSION_INPUT, input_value)
+        io_binding.bind_ortvalue_output(SESSION_OUTPUT, output_value)
+        IO_BINDINGS[batch_size] = (io_binding, input_value, output_value)
+    return IO_BINDINGS[batch_size]
 
-        # 3. Check Face/Image Ratio on Verification Image (img2)
-        facial_areas = result.get("facial_areas", {})
-        img2_area = facial_areas.get("img2", {})
-        face_height = img2_area.get("h", 0)
-        
-        if face_height > 0:
-            ratio = face_height / ver_img_height
-            logger.info(f"Verification Image - ImgH: {ver_img_height}, FaceH: {face_height}, Ratio: {ratio:.2f}")
-            
-            if ratio < 0.50:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Face is too small ({int(ratio*100)}%). Please move closer (target: 50%+)."
-                )
+def run_arcface(crops: np.ndarray) -> np.ndarray:
+    """
+    Raw ArcFace output for an (N, 3, 112, 112) float32 batch.
+    On GPU the crops are copied straight into the pre-bound device buffer, so ORT doesn't
+    allocate and stage a fresh input/output on every call.
+    """
+    if not USE_IO_BINDING:
+        return SESSION.run(None, {SESSION_INPUT: crops})[0]
+
+    io_binding, input_value, output_value = get_io_binding(len(crops))
+    input_value.update_inplace(np.ascontiguousarray(crops, dtype=np.float32))
+    SESSION.run_with_iobinding(io_binding)
+    return output_value.numpy()
+
+def embed_batch(crops: np.ndarray) -> np.ndarray:
+    """
+    Runs ArcFace once over an (N, 3, 112, 112) batch of preprocessed crops.
+    Returns (N, 512) float32 embeddings, L2-normalized in place so cosine distance is a single dot.
+    """
+    embeddings = np.asarray(run_arcface(crops), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+def spoof_crop(img: np.ndarray, facial_area: dict, scale: float) -> np.ndarray:
+    """
+    Crops the face box enlarged by `scale` (shifted to stay inside the image) and resizes it
+    to the anti-spoofing input as a raw-valued float32 CHW tensor, as MiniFASNet was trained.
+    """
+    img_height, img_width = img.shape[:2]
+    x, y, w, h = facial_area["x"], facial_area["y"], facial_area["w"], facial_area["h"]
+    scale = min((img_height - 1) / h, (img_width - 1) / w, scale)
+    center_x, center_y = x + w / 2, y + h / 2
+    left, right = center_x - w * scale / 2, center_x + w * scale / 2
+    top, bottom = center_y - h * scale / 2, center_y + h * scale / 2
+    if left < 0:
+        left, right = 0, right - left
+    if top < 0:
+        top, bottom = 0, bottom - top
+    if right > img_width - 1:
+        left, right = left - (right - img_width + 1), img_width - 1
+    if bottom > img_height - 1:
+        top, bottom = top - (bottom - img_height + 1), img_height - 1
+    left, top, right, bottom = int(left), int(top), int(right), int(bottom)
+
+    crop = cv2.resize(img[top:bottom + 1, left:right + 1], (ANTISPOOF_CROP_SIZE, ANTISPOOF_CROP_SIZE))
+    return crop.astype(np.float32).transpose(2, 0, 1)
+
+def check_liveness(img: np.ndarray, facial_area: dict) -> tuple:
+    """
+    Runs the anti-spoofing model on a detected face. Returns (is_real, score).
+    Both MiniFASNet branches are fused into one ONNX graph (see export_models.py),
+    so this is a single session call returning their summed softmax over (fake, real, fake).
+    """
+    feeds = {
+        name: spoof_crop(img, facial_area, scale)[np.newaxis]
+        for name, scale in zip(SPOOFER_INPUTS, ANTISPOOF_SCALES)
+    }
+    prediction = SPOOFER.run(None, feeds)[0][0]
+    label = int(np.argmax(prediction))
+    return label == 1, float(prediction[label] / 2)
+
+async def run_inference(func, *args):
+    """
+    Runs blocking detection/inference code in a worker thread so the event loop keeps serving
+    other requests, with at most INFERENCE_CONCURRENCY jobs in flight.
+    """
+    async with INFERENCE_SEMAPHORE:
+        return await asyncio.to_thread(func, *args)
+
+class EmbeddingBatcher:
+    """
+    Funnels every ArcFace call in the process through one dedicated inference thread.
+    Crops queued by concurrent requests within BATCH_TIMEOUT of each other are stacked
+    into a single session run of up to MAX_BATCH_SIZE, and each request awaits its own rows.
+    """
+
+    def __init__(self, max_batch_size: int, timeout: float):
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="arcface")
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def embed(self, crops: np.ndarray) -> np.ndarray:
+        """ Queues (N, 3, 112, 112) preprocessed crops and returns their (N, 512) embeddings. """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for crop in crops:
+            future = loop.create_future()
+            self.queue.put_nowait((crop, future))
+            futures.append(future)
+        return np.stack(await asyncio.gather(*futures))
+
+    async def _collect(self) -> list:
+        """ Waits for one crop, then gathers more until the batch is full or the timeout passes. """
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            crops = np.stack([crop for crop, _ in batch])
+            try:
+                embeddings = await loop.run_in_executor(self.executor, embed_batch, crops)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+BATCHER = EmbeddingBatcher(MAX_BATCH_SIZE, BATCH_TIMEOUT)
+
+# --- Registered Embedding Cache ---
+# Registered images rarely change, so their detection result (L2-normalized embedding,
+# facial_area) is kept per URL (LRU). Only touched from the event loop, so no locking is needed.
+REG_EMBEDDINGS: OrderedDict = OrderedDict()
+
+def get_cached_reg_embedding(url: str):
+    """ Returns the cached (embedding, facial_area) for a registered image URL, or None. """
+    cached = REG_EMBEDDINGS.get(url)
+    if cached is not None:
+        REG_EMBEDDINGS.move_to_end(url)
+    return cached
+
+def cache_reg_embedding(url: str, cached: tuple):
+    REG_EMBEDDINGS[url] = cached
+    REG_EMBEDDINGS.move_to_end(url)
+    if len(REG_EMBEDDINGS) > REG_EMBEDDING_CACHE_SIZE:
+        REG_EMBEDDINGS.popitem(last=False)
+
+# --- Internal Verification Logic ---
+MIN_FACE_HEIGHT_RATIO = 0.50 # Verification face must fill 50%+ of the image height
+
+def detect_and_align(img: np.ndarray, min_height_ratio: float = 0.0) -> tuple:
+    """
+    Single detector pass over the image: spoof-checks the primary face, rejects it if it is
+    smaller than min_height_ratio of the image height, and returns (preprocessed aligned crop, face).
+    Runs before any ArcFace work so rejected faces never reach the embedding model.
+    """
+    face = detect_primary_face(img)
+    is_real, _ = check_liveness(img, face["facial_area"])
+    if not is_real:
+        raise ValueError("Spoof detected in given image.")
+
+    if min_height_ratio > 0:
+        img_height = img.shape[0]
+        face_height = face["facial_area"]["h"]
+        ratio = face_height / img_height
+        logger.info(f"Verification Image - ImgH: {img_height}, FaceH: {face_height}, Ratio: {ratio:.2f}")
+
+        if ratio < min_height_ratio:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Face is too small ({int(ratio*100)}%). Please move closer (target: {int(min_height_ratio*100)}%+)."
+            )
+
+    return preprocess(align_face(img, face["landmarks"])), face
+
+async def detect_align_embed(img: np.ndarray, min_height_ratio: float = 0.0) -> tuple:
+    """
+    Detects, checks, aligns and embeds the primary face of a single image.
+    Returns (L2-normalized embedding, facial_area).
+    """
+    crop, face = await run_inference(detect_and_align, img, min_height_ratio)
+    embedding = (await BATCHER.embed(crop[np.newaxis]))[0]
+    return embedding, face["facial_area"]
+
+async def perform_verification(verimg: np.ndarray, regimg: np.ndarray = None, reg_cached: tuple = None) -> tuple:
+    """
+    Embeds the faces and compares them by cosine distance.
+    Takes either the registered image or its cached (embedding, facial_area).
+    Returns (result dict, registered (embedding, facial_area)).
+    """
+    try:
+        tic = time.perf_counter()
+
+        if reg_cached is None:
+            # Detect/check both faces first, then embed both crops in one ArcFace forward pass
+            (ver_crop, ver_face), (reg_crop, reg_face) = await asyncio.gather(
+                run_inference(detect_and_align, verimg, MIN_FACE_HEIGHT_RATIO),
+                run_inference(detect_and_align, regimg),
+            )
+            embeddings = await BATCHER.embed(np.stack([ver_crop, reg_crop]))
+            ver_embedding, ver_area = embeddings[0], ver_face["facial_area"]
+            reg_cached = (embeddings[1], reg_face["facial_area"])
+        else:
+            ver_embedding, ver_area = await detect_align_embed(verimg, MIN_FACE_HEIGHT_RATIO)
+        reg_embedding, _ = reg_cached
+        ratio = ver_area["h"] / verimg.shape[0]
+
+        distance = 1.0 - float(np.dot(reg_embedding, ver_embedding))
 
         return {
-            "is_match": bool(result["verified"]),
-            "distance": result["distance"],
-            "threshold": result["threshold"],
-            "time": result["time"],
+            "is_match": distance <= VERIFICATION_THRESHOLD,
+            "distance": distance,
+            "threshold": VERIFICATION_THRESHOLD,
+            "time": round(time.perf_counter() - tic, 2),
             "ratio": round(ratio, 2)
-        }
+        }, reg_cached
 
     except ValueError as e:
-        # This catches "Face could not be detected" errors from DeepFace
+        # This catches "Face could not be detected" and spoofing errors
         logger.warning(f"Verification failed: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Face detection error: {str(e)}")
     except HTTPException as he:
@@ -111,34 +618,25 @@ def perform_verification(regimg: np.ndarray, verimg: np.ndarray) -> dict:
         logger.error(f"An unexpected error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-# --- API Endpoints ---
-
-# Detect Single Face
-@app.post("/detect-face")
-async def detect_face(payload: DetectFacePayload):
+async def check_single_face(img_arr: np.ndarray, route: str) -> dict:
     """
-    Validates that the uploaded image contains EXACTLY one face.
-    Returns the facial area and confidence if successful.
+    Validates that the decoded image contains EXACTLY one real, large enough face.
+    Shared by /detect-face and /detect-face-raw; `route` labels the log lines.
     """
-    logger.info("Received request for /detect-face")
-
-    # 1. Decode first to get image dimensions
-    img_arr = read_image_from_base64(payload.img)
     img_height, img_width, _ = img_arr.shape
     
     try:
-        # 1. Run Extraction
-        # enforce_detection=True raises ValueError if 0 faces are found
-        faces = DeepFace.extract_faces(
-            img_path=img_arr,
-            anti_spoofing=True
-        )
+        # 1. Run Detection
+        faces = await run_inference(detect_faces, img_arr)
         
         # 2. Check Face Count
         face_count = len(faces)
         
+        if face_count == 0:
+            raise ValueError("Face could not be detected in the image.")
+
         if face_count > 1:
-            logger.warning(f"Detection failed: Found {face_count} faces.")
+            logger.warning(f"{route} - Detection failed: Found {face_count} faces.")
             raise HTTPException(
                 status_code=400, 
                 detail=f"Registration failed: Found {face_count} faces. Please provide a photo with exactly one face."
@@ -148,20 +646,17 @@ async def detect_face(payload: DetectFacePayload):
         face_data = faces[0]
 
         # 4. Check Anti-Spoofing Result
-        # 'is_real' boolean key is added when anti_spoofing=True
-        is_real = face_data.get("is_real", True) 
-        antispoof_score = face_data.get("antispoof_score", 0)
+        is_real, antispoof_score = await run_inference(check_liveness, img_arr, face_data["facial_area"])
 
         if is_real is False:
-            logger.warning(f"Spoof detected! Score: {antispoof_score}")
+            logger.warning(f"{route} - Spoof detected! Score: {antispoof_score}")
             raise HTTPException(
                 status_code=400,
                 detail="Spoof detected. Please provide a live, real photo (no screens or printed photos)."
             )
         
         # 4. Check Size (Face Height vs Image Height)
-        facial_area = face_data.get("facial_area", {})
-        face_height = facial_area.get("h", 0)
+        face_height = face_data["facial_area"]["h"]
         
         height_ratio = face_height / img_height
         MIN_HEIGHT_RATIO = 0.50 # 50%
@@ -185,27 +680,68 @@ async def detect_face(payload: DetectFacePayload):
         }
 
     except ValueError as e:
-        # DeepFace raises ValueError if 0 faces are found (when enforce_detection=True)
-        logger.warning(f"Detection failed: No face found. {e}")
+        # Raised above if 0 faces are found
+        logger.warning(f"{route} - Detection failed: No face found. {e}")
         raise HTTPException(status_code=400, detail="No face detected in the image. Please try again.")
         
     except HTTPException as http_exc:
         raise http_exc
         
     except Exception as e:
-        logger.error(f"Unexpected error in /detect-face: {e}")
+        logger.error(f"Unexpected error in {route}: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@app.post("/verify") # NEW URL endpoint
+# --- API Endpoints ---
+
+# Detect Single Face
+@app.post("/detect-face", response_model=DetectFaceResponse)
+async def detect_face(payload: DetectFacePayload):
+    """
+    Validates that the uploaded image contains EXACTLY one face.
+    Returns the facial area and confidence if successful.
+    """
+    logger.info("Received request for /detect-face")
+
+    # 1. Decode, then run the shared checks
+    img_arr = read_image_from_base64(payload.img)
+    return await check_single_face(img_arr, "/detect-face")
+
+# Detect Single Face (raw bytes)
+@app.post("/detect-face-raw", response_model=DetectFaceResponse)
+async def detect_face_raw(img: UploadFile):
+    """
+    Same checks as /detect-face, for clients that can send the image as multipart/form-data
+    bytes instead of Base64 (no 33% size overhead, no base64 decode).
+    """
+    logger.info("Received request for /detect-face-raw")
+
+    img_arr = read_image_from_bytes(await img.read())
+    return await check_single_face(img_arr, "/detect-face-raw")
+
+@app.post("/verify", response_model=VerifyFaceResponse) # NEW URL endpoint
 async def verify_face(payload: VerifyFacePayload):
     logger.info("Received request for /verify (JSON)")
 
-    baseimage = read_image_from_url(payload.regimg)
     ver_arr = read_image_from_base64(payload.verimg)
 
-    result = perform_verification(baseimage, ver_arr)
+    # Skip the download and the registered-face forward pass when it's already embedded
+    reg_cached = get_cached_reg_embedding(payload.regimg)
+    if reg_cached is not None:
+        result, _ = await perform_verification(ver_arr, reg_cached=reg_cached)
+        return result
+
+    baseimage = await read_image_from_url(payload.regimg)
+    result, reg_cached = await perform_verification(ver_arr, regimg=baseimage)
+    cache_reg_embedding(payload.regimg, reg_cached)
     return result
 
 if __name__ == "__main__":
+    if "--build-engines" in sys.argv:
+        # One-shot: build TensorRT engines into TRT_ENGINE_CACHE_DIR so workers only deserialize them
+        load_sessions()
+        logger.info(f"Sessions built and cached in {TRT_ENGINE_CACHE_DIR}.")
+        sys.exit(0)
+
     logger.info("Starting face verification service on http://localhost:8001")
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # uvloop + httptools (both come with uvicorn[standard]); per-request access logging off
+    uvicorn.run(app, host="0.0.0.0", port=8001, loop="uvloop", http="httptools", access_log=False)
@@ -0,0 +1,138 @@
+"""
+One-off export of the models used by api.py.
+
+    pip install deepface tf2onnx torch
+    python export_models.py [--calibrate DIR]
+
+Writes into ./models:
+  - arcface.onnx: DeepFace's ArcFace, converted from Keras with an NCHW
+    (N, 3, 112, 112) float32 input named "input".
+  - face_detection_yunet_2023mar.onnx: the OpenCV Zoo face detector.
+  - anti_spoof.onnx: DeepFace's two MiniFASNet anti-spoofing models fused into
+    one graph taking both 80x80 crops and returning their summed softmax.
+  - trt_cache/calibration.flatbuffers (with --calibrate): TensorRT INT8
+    calibration table built from a folder of aligned 112x112 face crops,
+    used when the service runs with TRT_PRECISION=int8.
+"""
+import argparse
+import glob
+import logging
+import os
+import urllib.request
+
+import cv2
+import numpy as np
+import tensorflow as tf
+import tf2onnx
+from deepface import DeepFace
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+TRT_CACHE_DIR = os.path.join(MODELS_DIR, "trt_cache")
+YUNET_URL = (
+    "https://github.com/opencv/opencv_zoo/raw/main/models/"
+    "face_detection_yunet/face_detection_yunet_2023mar.onnx"
+)
+
+
+def export_arcface(output_path: str):
+    """Converts the Keras ArcFace model to ONNX with a dynamic batch axis."""
+    model = DeepFace.build_model("ArcFace").model
+    spec = (tf.TensorSpec((None, 112, 112, 3), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(
+        model,
+        input_signature=spec,
+        opset=17,
+        inputs_as_nchw=["input"],
+        output_path=output_path,
+    )
+
+
+def export_anti_spoof(output_path: str):
+    """Exports both Fasnet branches as a single two-input ONNX graph."""
+    import torch
+    import torch.nn.functional as F
+    from deepface.models.spoofing.FasNet import Fasnet
+
+    class FusedFasnet(torch.nn.Module):
+        def __init__(self, fasnet: Fasnet):
+            super().__init__()
+            self.first_model = fasnet.first_model
+            self.second_model = fasnet.second_model
+
+        def forward(self, crop_2_7, crop_4_0):
+            return F.softmax(self.first_model(crop_2_7), dim=1) + F.softmax(self.second_model(crop_4_0), dim=1)
+
+    model = FusedFasnet(Fasnet()).cpu().eval()
+    dummy = torch.zeros((1, 3, 80, 80), dtype=torch.float32)
+    torch.onnx.export(
+        model,
+        (dummy, dummy),
+        output_path,
+        input_names=["crop_2_7", "crop_4_0"],
+        output_names=["prediction"],
+        dynamic_axes={"crop_2_7": {0: "batch"}, "crop_4_0": {0: "batch"}, "prediction": {0: "batch"}},
+        opset_version=17,
+    )
+
+
+def download_detector(output_path: str):
+    """Fetches the YuNet face detector used through cv2.FaceDetectorYN."""
+    urllib.request.urlretrieve(YUNET_URL, output_path)
+
+
+class CropDataReader:
+    """Feeds aligned 112x112 crops to the calibrator, normalized like api.preprocess."""
+
+    def __init__(self, crops_dir: str):
+        self.paths = iter(sorted(glob.glob(os.path.join(crops_dir, "*"))))
+
+    def get_next(self):
+        for path in self.paths:
+            crop = cv2.imread(path, cv2.IMREAD_COLOR)
+            if crop is None:
+                continue
+            crop = cv2.resize(crop, (112, 112))
+            blob = crop.astype(np.float32) / 255.0
+            return {"input": blob.transpose(2, 0, 1)[np.newaxis]}
+        return None
+
+
+def write_int8_calibration(model_path: str, crops_dir: str):
+    """Collects activation ranges over crops_dir and writes TensorRT's INT8 calibration table."""
+    from onnxruntime.quantization import create_calibrator, write_calibration_table
+
+    os.makedirs(TRT_CACHE_DIR, exist_ok=True)
+    calibrator = create_calibrator(
+        model_path, augmented_model_path=os.path.join(TRT_CACHE_DIR, "augmented_arcface.onnx")
+    )
+    calibrator.collect_data(CropDataReader(crops_dir))
+    write_calibration_table(calibrator.compute_data(), dir=TRT_CACHE_DIR)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calibrate", metavar="DIR", help="folder of aligned face crops for INT8 calibration")
+    args = parser.parse_args()
+
+    os.makedirs(MODELS_DIR, exist_ok=True)
+
+    arcface_path = os.path.join(MODELS_DIR, "arcface.onnx")
+    logger.info(f"Exporting ArcFace to {arcface_path}...")
+    export_arcface(arcface_path)
+
+    anti_spoof_path = os.path.join(MODELS_DIR, "anti_spoof.onnx")
+    logger.info(f"Exporting anti-spoofing models to {anti_spoof_path}...")
+    export_anti_spoof(anti_spoof_path)
+
+    detector_path = os.path.join(MODELS_DIR, "face_detection_yunet_2023mar.onnx")
+    logger.info(f"Downloading face detector to {detector_path}...")
+    download_detector(detector_path)
+
+    if args.calibrate:
+        logger.info(f"Writing INT8 calibration table from {args.calibrate}...")
+        write_int8_calibration(arcface_path, args.calibrate)
+
+    logger.info("Models exported successfully.")
@@ -0,0 +1,30 @@
+"""
+Production server settings:
+
+    gunicorn api:app -c gunicorn.conf.py
+
+Each worker is a separate process with its own model sessions and ArcFace batcher,
+so keep WEB_CONCURRENCY x (ORT_INTRA_OP_THREADS + 1) at or below the core count
+(the +1 is the single-threaded anti-spoofing session).
+"""
+import os
+import subprocess
+import sys
+
+bind = "0.0.0.0:8001"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn_worker.UvicornWorker"
+# UvicornWorker already picks uvloop + httptools when installed; no per-request access log
+accesslog = None
+# Workers only deserialize the prebuilt TensorRT engine (see on_starting), which fits well within this
+timeout = 120
+
+
+def on_starting(server):
+    """
+    Builds the TensorRT engines once, in a separate process, before any worker is forked.
+    A first-time FP16/INT8 build can outlast the worker timeout, and concurrent workers would
+    otherwise all build the same engine and race on models/trt_cache. No-op once cached.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, os.path.join(here, "api.py"), "--build-engines"], cwd=here, check=True)